@@ -1,12 +1,20 @@
 use anyhow::{Context, Result};
+use reqwest::blocking::RequestBuilder;
 use serde::{Deserialize, Serialize};
 use std::fs;
+use std::io::{ErrorKind, Write};
 use std::path::PathBuf;
+use std::sync::{Mutex, PoisonError};
+use std::thread::{self, JoinHandle};
+use std::time::{Duration, SystemTime, UNIX_EPOCH};
 
 #[cfg(unix)]
-use std::os::unix::fs::PermissionsExt;
+use std::os::unix::fs::OpenOptionsExt;
 
-use crate::jwt::parse_jwt_claims;
+use crate::config::{CLIENT_ID, OAUTH_TOKEN_URL, REFRESH_HARD_MARGIN_SECS, REFRESH_LEEWAY_SECS};
+use crate::http;
+use crate::jwt::{chatgpt_account_id, token_exp};
+use crate::log;
 
 #[derive(Debug, Clone, Serialize, Deserialize)]
 pub struct Tokens {
@@ -25,11 +33,10 @@ pub struct AuthData {
 impl AuthData {
     pub fn load() -> Result<Option<Self>> {
         let path = Self::auth_path()?;
-        if path.exists() {
-            let content = fs::read_to_string(&path)?;
-            Ok(Some(serde_json::from_str(&content)?))
-        } else {
-            Ok(None)
+        match fs::read(&path) {
+            Ok(content) => Ok(Some(serde_json::from_slice(&content)?)),
+            Err(e) if e.kind() == ErrorKind::NotFound => Ok(None),
+            Err(e) => Err(e.into()),
         }
     }
 
@@ -39,14 +46,29 @@ impl AuthData {
             fs::create_dir_all(parent)?;
         }
         let content = serde_json::to_string_pretty(self)?;
-        fs::write(&path, &content)?;
 
-        // Set file permissions to 600 (owner read/write only) - Unix only
+        // Write a temp file and rename it over auth.json, so a crash mid-write
+        // never leaves a truncated token file behind. The temp name is unique
+        // per process, so a login and a refresh saving at once never write
+        // into the same file.
+        let tmp = path.with_extension(format!("json.{}.tmp", std::process::id()));
+        let mut options = fs::OpenOptions::new();
+        options.write(true).create(true).truncate(true);
+        // Create with permissions 600 (owner read/write only) - Unix only
         #[cfg(unix)]
-        {
-            let mut perms = fs::metadata(&path)?.permissions();
-            perms.set_mode(0o600);
-            fs::set_permissions(&path, perms)?;
+        options.mode(0o600);
+
+        let written = options
+            .open(&tmp)
+            .and_then(|mut file| {
+                file.write_all(content.as_bytes())?;
+                file.sync_all()
+            })
+            .and_then(|()| fs::rename(&tmp, &path));
+        if let Err(e) = written {
+            // Don't leave a stray copy of the credentials behind.
+            let _ = fs::remove_file(&tmp);
+            return Err(e.into());
         }
 
         Ok(())
@@ -58,24 +80,60 @@ impl AuthData {
         Ok(home.join(".jose").join("auth.json"))
     }
 
+    /// Sidecar file locked around token refresh. A separate file is used so the
+    /// lock survives auth.json itself being rewritten.
+    fn lock_path() -> Result<PathBuf> {
+        Ok(Self::auth_path()?.with_extension("lock"))
+    }
+
+    /// Seconds until the access token expires, if its `exp` claim is readable
+    fn expires_in(&self) -> Option<i64> {
+        token_exp(&self.tokens.access_token).map(|exp| exp - unix_now())
+    }
+
     /// Check if the access token is expired or about to expire
     pub fn needs_refresh(&self) -> bool {
-        if let Some(claims) = parse_jwt_claims(&self.tokens.access_token) {
-            if let Some(exp) = claims.get("exp").and_then(|v| v.as_i64()) {
-                let now = chrono::Utc::now().timestamp();
-                // Refresh if token expires within 5 minutes
-                return exp <= now + 300;
-            }
-        }
-        true
+        self.expires_in()
+            .is_none_or(|left| left <= REFRESH_LEEWAY_SECS)
     }
 }
 
-use crate::config::{CLIENT_ID, OAUTH_TOKEN_URL};
+/// Current Unix time in seconds, read straight from the system clock.
+fn unix_now() -> i64 {
+    SystemTime::now()
+        .duration_since(UNIX_EPOCH)
+        .map(|d| d.as_secs() as i64)
+        .unwrap_or(0)
+}
 
-pub fn refresh_tokens(refresh_token: &str) -> Result<Tokens> {
-    let client = reqwest::blocking::Client::new();
+/// Successful response body of the OAuth token endpoint.
+#[derive(Debug, Deserialize)]
+pub struct TokenResponse {
+    pub id_token: String,
+    pub access_token: String,
+    /// May be absent on refresh when the provider doesn't rotate it.
+    pub refresh_token: Option<String>,
+}
 
+/// Send a token-endpoint request and decode the response straight into a
+/// `TokenResponse`. `grant` names the operation in error messages.
+pub fn send_token_request(request: RequestBuilder, grant: &str) -> Result<TokenResponse> {
+    let resp = request
+        .timeout(Duration::from_secs(30))
+        .send()
+        .with_context(|| format!("Failed to send token {} request", grant))?;
+
+    if !resp.status().is_success() {
+        let status = resp.status();
+        let body = resp.text().unwrap_or_default();
+        anyhow::bail!("Token {} failed: {} - {}", grant, status, body);
+    }
+
+    resp.json()
+        .with_context(|| format!("Invalid token {} response", grant))
+}
+
+pub fn refresh_tokens(refresh_token: &str) -> Result<Tokens> {
     let payload = serde_json::json!({
         "grant_type": "refresh_token",
         "refresh_token": refresh_token,
@@ -83,67 +141,102 @@ pub fn refresh_tokens(refresh_token: &str) -> Result<Tokens> {
         "scope": "openid profile email offline_access",
     });
 
-    let resp = client
-        .post(OAUTH_TOKEN_URL)
-        .json(&payload)
-        .timeout(std::time::Duration::from_secs(30))
-        .send()
-        .context("Failed to send refresh token request")?;
+    let data = send_token_request(
+        http::client().post(OAUTH_TOKEN_URL).json(&payload),
+        "refresh",
+    )?;
 
-    if !resp.status().is_success() {
-        anyhow::bail!("Token refresh failed: {}", resp.status());
+    Ok(Tokens {
+        account_id: chatgpt_account_id(&data.id_token).unwrap_or_default(),
+        id_token: data.id_token,
+        access_token: data.access_token,
+        refresh_token: data
+            .refresh_token
+            .unwrap_or_else(|| refresh_token.to_string()),
+    })
+}
+
+/// Refresh the stored tokens while holding an exclusive lock on the auth lock
+/// file, so concurrent jose processes (or threads) never spend the same
+/// rotating refresh token twice. Whoever acquires the lock second re-reads
+/// auth.json and reuses the tokens the first one just saved.
+fn refresh_locked() -> Result<Option<Tokens>> {
+    let lock_path = AuthData::lock_path()?;
+    if let Some(parent) = lock_path.parent() {
+        fs::create_dir_all(parent)?;
     }
+    let lock = fs::OpenOptions::new()
+        .create(true)
+        .truncate(false)
+        .write(true)
+        .open(&lock_path)?;
+    lock.lock().context("Failed to lock auth file")?;
 
-    let data: serde_json::Value = resp.json()?;
-
-    let id_token = data["id_token"]
-        .as_str()
-        .ok_or_else(|| anyhow::anyhow!("Missing id_token"))?
-        .to_string();
-    let access_token = data["access_token"]
-        .as_str()
-        .ok_or_else(|| anyhow::anyhow!("Missing access_token"))?
-        .to_string();
-    let new_refresh_token = data["refresh_token"]
-        .as_str()
-        .unwrap_or(refresh_token)
-        .to_string();
-
-    // Extract account_id from id_token claims
-    let account_id = parse_jwt_claims(&id_token)
-        .and_then(|claims| {
-            claims
-                .get("https://api.openai.com/auth")
-                .and_then(|auth| auth.get("chatgpt_account_id"))
-                .and_then(|v| v.as_str())
-                .map(|s| s.to_string())
-        })
-        .unwrap_or_default();
+    let auth = match AuthData::load()? {
+        Some(auth) => auth,
+        None => return Ok(None),
+    };
+    if !auth.needs_refresh() {
+        return Ok(Some(auth.tokens));
+    }
 
-    Ok(Tokens {
-        id_token,
-        access_token,
-        refresh_token: new_refresh_token,
-        account_id,
-    })
+    let new_auth = AuthData {
+        tokens: refresh_tokens(&auth.tokens.refresh_token)?,
+        last_refresh: chrono::Utc::now().to_rfc3339(),
+    };
+    new_auth.save()?;
+    Ok(Some(new_auth.tokens))
+}
+
+/// Handle of this process's background refresh, if one was started.
+static BACKGROUND_REFRESH: Mutex<Option<JoinHandle<()>>> = Mutex::new(None);
+
+/// Refresh on a worker thread while the caller carries on with the current,
+/// still-valid token. At most one refresher runs per process; other processes
+/// are kept out by the refresh lock.
+fn spawn_background_refresh() {
+    let mut slot = BACKGROUND_REFRESH
+        .lock()
+        .unwrap_or_else(PoisonError::into_inner);
+    if slot.is_some() {
+        return;
+    }
+    *slot = Some(thread::spawn(|| {
+        if let Err(e) = refresh_locked() {
+            log::warn(&format!("Background token refresh failed: {}", e));
+        }
+    }));
+}
+
+/// Wait for a background refresh to finish. Call before exiting, so the
+/// process never dies between the provider rotating the refresh token and the
+/// new one being saved.
+pub fn wait_for_background_refresh() {
+    let handle = BACKGROUND_REFRESH
+        .lock()
+        .unwrap_or_else(PoisonError::into_inner)
+        .take();
+    if let Some(handle) = handle {
+        let _ = handle.join();
+    }
 }
 
-/// Get valid tokens, refreshing if necessary
+/// Get valid tokens, refreshing if necessary. A token that is expired or within
+/// `REFRESH_HARD_MARGIN_SECS` of expiry is refreshed before returning; one that
+/// is merely within `REFRESH_LEEWAY_SECS` is returned as-is and refreshed in
+/// the background.
 pub fn get_valid_tokens() -> Result<Option<Tokens>> {
     let auth = match AuthData::load()? {
         Some(auth) => auth,
         None => return Ok(None),
     };
 
-    if auth.needs_refresh() {
-        let new_tokens = refresh_tokens(&auth.tokens.refresh_token)?;
-        let new_auth = AuthData {
-            tokens: new_tokens.clone(),
-            last_refresh: chrono::Utc::now().to_rfc3339(),
-        };
-        new_auth.save()?;
-        Ok(Some(new_tokens))
-    } else {
-        Ok(Some(auth.tokens))
+    // One JWT decode decides between: still fresh, usable but due for a
+    // background refresh, or (nearly) expired / unreadable and refreshed in place.
+    match auth.expires_in() {
+        Some(left) if left > REFRESH_LEEWAY_SECS => {}
+        Some(left) if left > REFRESH_HARD_MARGIN_SECS => spawn_background_refresh(),
+        _ => return refresh_locked(),
     }
+    Ok(Some(auth.tokens))
 }
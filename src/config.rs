@@ -1,6 +1,7 @@
 use anyhow::Result;
 use serde::{Deserialize, Serialize};
 use std::fs;
+use std::io::ErrorKind;
 use std::path::PathBuf;
 
 /// OAuth configuration (same as Codex CLI)
@@ -9,6 +10,13 @@ pub const OAUTH_ISSUER: &str = "https://auth.openai.com";
 pub const OAUTH_TOKEN_URL: &str = "https://auth.openai.com/oauth/token";
 pub const CHATGPT_RESPONSES_URL: &str = "https://chatgpt.com/backend-api/codex/responses";
 
+/// Refresh the access token once it is within this many seconds of expiry.
+pub const REFRESH_LEEWAY_SECS: i64 = 300;
+
+/// Below this many seconds to expiry, refresh before sending a request rather
+/// than in the background; covers clock skew and slow requests.
+pub const REFRESH_HARD_MARGIN_SECS: i64 = 60;
+
 /// Must use port 1455 - this is the only port registered with OpenAI's OAuth
 pub const OAUTH_PORT: u16 = 1455;
 
@@ -72,11 +80,10 @@ impl Default for Config {
 impl Config {
     pub fn load() -> Result<Self> {
         let path = Self::config_path()?;
-        if path.exists() {
-            let content = fs::read_to_string(&path)?;
-            Ok(serde_json::from_str(&content)?)
-        } else {
-            Ok(Self::default())
+        match fs::read(&path) {
+            Ok(content) => Ok(serde_json::from_slice(&content)?),
+            Err(e) if e.kind() == ErrorKind::NotFound => Ok(Self::default()),
+            Err(e) => Err(e.into()),
         }
     }
 
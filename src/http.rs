@@ -0,0 +1,11 @@
+//! Shared HTTP client for all outbound requests.
+
+use std::sync::OnceLock;
+
+/// Process-wide blocking client, built on first use. Sharing it means the TLS
+/// connector and the client's background runtime are set up once per process
+/// rather than once per request.
+pub fn client() -> &'static reqwest::blocking::Client {
+    static CLIENT: OnceLock<reqwest::blocking::Client> = OnceLock::new();
+    CLIENT.get_or_init(reqwest::blocking::Client::new)
+}
@@ -1,14 +1,50 @@
 use base64::{engine::general_purpose::URL_SAFE_NO_PAD, Engine};
+use serde::Deserialize;
 use serde_json::Value;
 
+/// Decode the payload segment of a JWT (without verification)
+fn decode_payload(token: &str) -> Option<Vec<u8>> {
+    let mut parts = token.split('.');
+    let (_header, payload, _signature) = (parts.next()?, parts.next()?, parts.next()?);
+    if parts.next().is_some() {
+        return None;
+    }
+    URL_SAFE_NO_PAD.decode(payload).ok()
+}
+
 /// Parse JWT claims from a token (without verification)
 pub fn parse_jwt_claims(token: &str) -> Option<Value> {
-    let parts: Vec<&str> = token.split('.').collect();
-    if parts.len() != 3 {
-        return None;
+    serde_json::from_slice(&decode_payload(token)?).ok()
+}
+
+/// Read only the `exp` claim. Unlike `parse_jwt_claims`, the remaining claims
+/// are skipped by the deserializer rather than built into a `Value` tree.
+pub fn token_exp(token: &str) -> Option<i64> {
+    #[derive(Deserialize)]
+    struct Claims {
+        exp: Option<i64>,
+    }
+
+    serde_json::from_slice::<Claims>(&decode_payload(token)?)
+        .ok()?
+        .exp
+}
+
+/// Read the ChatGPT account id from an id_token's OpenAI auth claim.
+pub fn chatgpt_account_id(id_token: &str) -> Option<String> {
+    #[derive(Deserialize)]
+    struct AuthClaim {
+        chatgpt_account_id: Option<String>,
+    }
+
+    #[derive(Deserialize)]
+    struct Claims {
+        #[serde(rename = "https://api.openai.com/auth")]
+        auth: Option<AuthClaim>,
     }
 
-    let payload = parts[1];
-    let decoded = URL_SAFE_NO_PAD.decode(payload).ok()?;
-    serde_json::from_slice(&decoded).ok()
+    serde_json::from_slice::<Claims>(&decode_payload(id_token)?)
+        .ok()?
+        .auth?
+        .chatgpt_account_id
 }
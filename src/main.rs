@@ -1,6 +1,7 @@
 mod auth;
 mod clipboard;
 mod config;
+mod http;
 mod jwt;
 mod log;
 mod oauth;
@@ -255,7 +256,10 @@ fn main() -> Result<()> {
             }
 
             let prompt = cli.prompt.join(" ");
-            cmd_query(&prompt, cli.model.as_deref())?;
+            let result = cmd_query(&prompt, cli.model.as_deref());
+            // Let a background token refresh finish so the rotated token is saved.
+            auth::wait_for_background_refresh();
+            result?;
         }
     }
 
@@ -1,14 +1,16 @@
-use anyhow::{Context, Result};
+use anyhow::Result;
 use base64::{engine::general_purpose::URL_SAFE_NO_PAD, Engine};
 use rand::distr::{Alphanumeric, SampleString};
 use sha2::{Digest, Sha256};
-use std::collections::HashMap;
-use std::io::{BufRead, BufReader, Write};
+use std::io::{BufRead, BufReader, ErrorKind, Write};
 use std::net::TcpListener;
+use std::thread;
+use std::time::{Duration, Instant};
 
-use crate::auth::{AuthData, Tokens};
+use crate::auth::{send_token_request, AuthData, Tokens};
 use crate::config::{CLIENT_ID, OAUTH_ISSUER, OAUTH_PORT, OAUTH_TOKEN_URL};
-use crate::jwt::parse_jwt_claims;
+use crate::http;
+use crate::jwt::chatgpt_account_id;
 use crate::log;
 
 #[derive(Debug, Clone)]
@@ -19,7 +21,9 @@ pub struct PkceCodes {
 
 impl PkceCodes {
     pub fn generate() -> Self {
-        let code_verifier: String = Alphanumeric.sample_string(&mut rand::rng(), 128);
+        // 64 random bytes encode to an 86-char base64url verifier: 512 bits of
+        // entropy, within RFC 7636's 43-128 character range.
+        let code_verifier = URL_SAFE_NO_PAD.encode(rand::random::<[u8; 64]>());
         let digest = Sha256::digest(code_verifier.as_bytes());
         let code_challenge = URL_SAFE_NO_PAD.encode(digest);
 
@@ -60,7 +64,6 @@ pub fn build_auth_url(pkce: &PkceCodes, state: &str) -> String {
 
 fn exchange_code(code: &str, pkce: &PkceCodes) -> Result<Tokens> {
     let redirect_uri = redirect_uri();
-    let client = reqwest::blocking::Client::new();
 
     let body = format!(
         "grant_type=authorization_code&code={}&redirect_uri={}&client_id={}&code_verifier={}",
@@ -70,73 +73,48 @@ fn exchange_code(code: &str, pkce: &PkceCodes) -> Result<Tokens> {
         urlencoding::encode(&pkce.code_verifier)
     );
 
-    let resp = client
-        .post(OAUTH_TOKEN_URL)
-        .header("Content-Type", "application/x-www-form-urlencoded")
-        .body(body)
-        .timeout(std::time::Duration::from_secs(30))
-        .send()
-        .context("Failed to exchange code")?;
-
-    if !resp.status().is_success() {
-        let status = resp.status();
-        let body = resp.text().unwrap_or_default();
-        anyhow::bail!("Token exchange failed: {} - {}", status, body);
-    }
-
-    let data: serde_json::Value = resp.json()?;
-
-    let id_token = data["id_token"]
-        .as_str()
-        .ok_or_else(|| anyhow::anyhow!("Missing id_token"))?
-        .to_string();
-    let access_token = data["access_token"]
-        .as_str()
-        .ok_or_else(|| anyhow::anyhow!("Missing access_token"))?
-        .to_string();
-    let refresh_token = data["refresh_token"]
-        .as_str()
-        .ok_or_else(|| anyhow::anyhow!("Missing refresh_token"))?
-        .to_string();
-
-    // Extract account_id from id_token claims
-    let account_id = parse_jwt_claims(&id_token)
-        .and_then(|claims| {
-            claims
-                .get("https://api.openai.com/auth")
-                .and_then(|auth| auth.get("chatgpt_account_id"))
-                .and_then(|v| v.as_str())
-                .map(|s| s.to_string())
-        })
-        .unwrap_or_default();
+    let data = send_token_request(
+        http::client()
+            .post(OAUTH_TOKEN_URL)
+            .header("Content-Type", "application/x-www-form-urlencoded")
+            .body(body),
+        "exchange",
+    )?;
+    let refresh_token = data
+        .refresh_token
+        .ok_or_else(|| anyhow::anyhow!("Missing refresh_token"))?;
 
     Ok(Tokens {
-        id_token,
-        access_token,
+        account_id: chatgpt_account_id(&data.id_token).unwrap_or_default(),
+        id_token: data.id_token,
+        access_token: data.access_token,
         refresh_token,
-        account_id,
     })
 }
 
-/// Parse the query string of the request line `GET /path?query HTTP/1.1`.
-fn parse_request_query(request_line: &str) -> HashMap<String, String> {
-    request_line
+/// Pull `code` and `state` out of the request line `GET /path?query HTTP/1.1`
+/// in a single pass; other parameters are skipped without being decoded.
+fn callback_params(request_line: &str) -> (Option<String>, Option<String>) {
+    let query = request_line
         .split_whitespace()
         .nth(1)
         .and_then(|path| path.split_once('?'))
-        .map(|(_, query)| {
-            query
-                .split('&')
-                .filter_map(|pair| pair.split_once('='))
-                .map(|(k, v)| {
-                    (
-                        k.to_string(),
-                        urlencoding::decode(v).map(|s| s.into_owned()).unwrap_or_default(),
-                    )
-                })
-                .collect()
-        })
-        .unwrap_or_default()
+        .map_or("", |(_, query)| query);
+
+    let (mut code, mut state) = (None, None);
+    for (k, v) in query.split('&').filter_map(|pair| pair.split_once('=')) {
+        let slot = match k {
+            "code" => &mut code,
+            "state" => &mut state,
+            _ => continue,
+        };
+        *slot = Some(
+            urlencoding::decode(v)
+                .map(|s| s.into_owned())
+                .unwrap_or_default(),
+        );
+    }
+    (code, state)
 }
 
 const SUCCESS_HTML: &str = r#"<html>
@@ -154,13 +132,60 @@ fn http_response(status: &str, body: &str) -> String {
     )
 }
 
-/// Block on a one-shot HTTP server until the OAuth callback delivers a code.
+/// How long to wait for the browser to complete the OAuth flow.
+const LOGIN_TIMEOUT: Duration = Duration::from_secs(300);
+
+/// Interval between accept attempts on the non-blocking listener.
+const ACCEPT_POLL_INTERVAL: Duration = Duration::from_millis(50);
+
+/// Read timeout for a single connection, so an idle browser preconnect can't
+/// stall the server while the real callback waits behind it.
+const CONNECTION_READ_TIMEOUT: Duration = Duration::from_secs(5);
+
+/// Serve a one-shot HTTP server until the OAuth callback delivers a code or
+/// `LOGIN_TIMEOUT` elapses.
 fn wait_for_callback(listener: &TcpListener, pkce: &PkceCodes, state: &str) -> Result<Tokens> {
-    for stream in listener.incoming() {
-        let mut stream = stream?;
+    listener.set_nonblocking(true)?;
+    let deadline = Instant::now() + LOGIN_TIMEOUT;
+
+    loop {
+        let mut stream = match listener.accept() {
+            Ok((stream, _)) => stream,
+            Err(e) if e.kind() == ErrorKind::WouldBlock => {
+                if Instant::now() >= deadline {
+                    anyhow::bail!(
+                        "Timed out after {}s waiting for the authentication callback",
+                        LOGIN_TIMEOUT.as_secs()
+                    );
+                }
+                thread::sleep(ACCEPT_POLL_INTERVAL);
+                continue;
+            }
+            // A client that gave up mid-handshake, or a signal, isn't fatal.
+            Err(e)
+                if matches!(
+                    e.kind(),
+                    ErrorKind::ConnectionAborted
+                        | ErrorKind::ConnectionReset
+                        | ErrorKind::Interrupted
+                ) =>
+            {
+                continue;
+            }
+            Err(e) => return Err(e.into()),
+        };
+        // Accepted sockets may inherit the listener's non-blocking mode.
+        stream.set_nonblocking(false)?;
+        stream.set_read_timeout(Some(CONNECTION_READ_TIMEOUT))?;
 
         let mut request_line = String::new();
-        BufReader::new(&stream).read_line(&mut request_line)?;
+        if BufReader::new(&stream)
+            .read_line(&mut request_line)
+            .is_err()
+        {
+            // Idle or aborted connection; keep waiting for the callback.
+            continue;
+        }
 
         // Ignore anything that isn't the OAuth callback (e.g. favicon).
         if !request_line.contains("/auth/callback") {
@@ -168,26 +193,22 @@ fn wait_for_callback(listener: &TcpListener, pkce: &PkceCodes, state: &str) -> R
             continue;
         }
 
-        let params = parse_request_query(&request_line);
+        let (code, callback_state) = callback_params(&request_line);
 
-        if params.get("state").map(String::as_str) != Some(state) {
+        if callback_state.as_deref() != Some(state) {
             let _ = stream.write_all(
                 http_response("400 Bad Request", "<h1>Error</h1><p>State mismatch</p>").as_bytes(),
             );
             anyhow::bail!("OAuth state mismatch - possible CSRF, aborting.");
         }
 
-        let code = params
-            .get("code")
-            .ok_or_else(|| anyhow::anyhow!("Missing authorization code in callback"))?;
+        let code = code.ok_or_else(|| anyhow::anyhow!("Missing authorization code in callback"))?;
 
-        let tokens = exchange_code(code, pkce)?;
+        let tokens = exchange_code(&code, pkce)?;
         let _ = stream.write_all(http_response("200 OK", SUCCESS_HTML).as_bytes());
         let _ = stream.flush();
         return Ok(tokens);
     }
-
-    anyhow::bail!("Listener closed before receiving callback")
 }
 
 pub fn do_login() -> Result<bool> {
@@ -198,11 +219,15 @@ pub fn do_login() -> Result<bool> {
     let state_token: String = Alphanumeric.sample_string(&mut rand::rng(), 64);
 
     let addr = format!("127.0.0.1:{}", OAUTH_PORT);
+    // std enables SO_REUSEADDR on Unix, so a socket a previous login left in
+    // TIME_WAIT doesn't block the bind; AddrInUse means a live listener.
     let listener = match TcpListener::bind(&addr) {
         Ok(l) => l,
         Err(e) => {
-            log::error(&format!("Port {} is already in use.", OAUTH_PORT));
-            log::info("Make sure ChatMock or another instance is not running.");
+            if e.kind() == ErrorKind::AddrInUse {
+                log::error(&format!("Port {} is already in use.", OAUTH_PORT));
+                log::info("Make sure ChatMock or another `jose login` is not running.");
+            }
             return Err(anyhow::anyhow!("Failed to bind: {}", e));
         }
     };
@@ -1,43 +1,95 @@
 //! Command-generation backends behind a single entrypoint.
 
 use anyhow::{Context, Result};
+use serde::{Deserialize, Serialize};
+use std::borrow::Cow;
 use std::io::{BufRead, BufReader};
 use std::time::Duration;
 
 use crate::auth::get_valid_tokens;
 use crate::config::{Config, ProviderKind, CHATGPT_RESPONSES_URL};
+use crate::http;
 use crate::prompt::build_system_prompt;
 
 /// Generate command suggestions for `prompt` using the configured provider.
 pub fn generate(config: &Config, prompt: &str, model: &str) -> Result<String> {
-    let system_prompt = build_system_prompt();
     match config.provider {
-        ProviderKind::Chatgpt => call_chatgpt(prompt, model, &system_prompt),
-        ProviderKind::OpenAiCompatible => call_openai_compatible(config, prompt, model, &system_prompt),
+        ProviderKind::Chatgpt => call_chatgpt(prompt, model),
+        ProviderKind::OpenAiCompatible => call_openai_compatible(config, prompt, model),
     }
 }
 
+/// A chat message in a request body.
+#[derive(Serialize)]
+struct Message<'a> {
+    role: &'static str,
+    content: &'a str,
+}
+
+impl<'a> Message<'a> {
+    fn system(content: &'a str) -> Self {
+        Self {
+            role: "system",
+            content,
+        }
+    }
+
+    fn user(content: &'a str) -> Self {
+        Self {
+            role: "user",
+            content,
+        }
+    }
+}
+
+/// Request body of the ChatGPT Responses API. Fields borrow the prompt strings
+/// and serialize straight from them, instead of `json!` copying each one into
+/// a `Value` tree first.
+#[derive(Serialize)]
+struct ResponsesRequest<'a> {
+    model: &'a str,
+    instructions: &'a str,
+    input: [Message<'a>; 1],
+    tools: &'static [serde_json::Value],
+    tool_choice: &'static str,
+    parallel_tool_calls: bool,
+    store: bool,
+    stream: bool,
+}
+
+/// Request body of an OpenAI-compatible `/chat/completions` call.
+#[derive(Serialize)]
+struct ChatCompletionRequest<'a> {
+    model: &'a str,
+    messages: [Message<'a>; 2],
+    stream: bool,
+}
+
 /// ChatGPT subscription backend: OAuth bearer + streaming Responses API.
-fn call_chatgpt(prompt: &str, model: &str, system_prompt: &str) -> Result<String> {
+fn call_chatgpt(prompt: &str, model: &str) -> Result<String> {
     let tokens = get_valid_tokens()?
         .ok_or_else(|| anyhow::anyhow!("Not authenticated. Run `jose login` first."))?;
+    // Probe the environment only once we know the request can be sent.
+    let system_prompt = build_system_prompt();
 
-    let payload = serde_json::json!({
-        "model": model,
-        "instructions": system_prompt,
-        "input": [{"role": "user", "content": prompt}],
-        "tools": [],
-        "tool_choice": "auto",
-        "parallel_tool_calls": false,
-        "store": false,
-        "stream": true,
-    });
-
-    let resp = reqwest::blocking::Client::new()
+    let payload = ResponsesRequest {
+        model,
+        instructions: &system_prompt,
+        input: [Message::user(prompt)],
+        tools: &[],
+        tool_choice: "auto",
+        parallel_tool_calls: false,
+        store: false,
+        stream: true,
+    };
+
+    let resp = http::client()
         .post(CHATGPT_RESPONSES_URL)
         .header("Authorization", format!("Bearer {}", tokens.access_token))
         .header("Content-Type", "application/json")
         .header("Accept", "text/event-stream")
+        // Keep the event stream uncompressed so deltas are readable as they arrive.
+        .header("Accept-Encoding", "identity")
         .header("chatgpt-account-id", &tokens.account_id)
         .header("OpenAI-Beta", "responses=experimental")
         .json(&payload)
@@ -53,40 +105,83 @@ fn call_chatgpt(prompt: &str, model: &str, system_prompt: &str) -> Result<String
 
     // Parse SSE stream
     let mut out = String::new();
-    for line in BufReader::new(resp).lines() {
-        let line = line?;
-        let Some(data) = line.strip_prefix("data: ") else {
-            continue;
+    for_each_sse_data(BufReader::with_capacity(SSE_BUFFER_SIZE, resp), |data| {
+        let Ok(event) = serde_json::from_slice::<StreamEvent>(data) else {
+            return;
         };
-        if data == "[DONE]" {
+        match event.delta {
+            Some(Delta::Text(text)) => out.push_str(&text),
+            Some(Delta::Part { text: Some(text) })
+                if event.kind.as_deref() != Some("response.output_text.delta") =>
+            {
+                out.push_str(&text)
+            }
+            _ => {}
+        }
+    })?;
+
+    Ok(trim_in_place(out))
+}
+
+/// Trim surrounding whitespace without copying the accumulated text again.
+fn trim_in_place(mut s: String) -> String {
+    s.truncate(s.trim_end().len());
+    let leading = s.len() - s.trim_start().len();
+    s.drain(..leading);
+    s
+}
+
+/// The text-bearing part of a Responses API stream event. Fields borrow from
+/// the line buffer and everything else in the event is skipped, so no
+/// `serde_json::Value` tree is built per streamed token.
+#[derive(Deserialize)]
+struct StreamEvent<'a> {
+    #[serde(borrow, rename = "type")]
+    kind: Option<Cow<'a, str>>,
+    #[serde(borrow)]
+    delta: Option<Delta<'a>>,
+}
+
+/// A `delta` is either the text itself or an object carrying a `text` field.
+#[derive(Deserialize)]
+#[serde(untagged)]
+enum Delta<'a> {
+    Text(#[serde(borrow)] Cow<'a, str>),
+    Part {
+        #[serde(borrow)]
+        text: Option<Cow<'a, str>>,
+    },
+}
+
+/// Read buffer for the SSE stream; large enough to take most network reads whole.
+const SSE_BUFFER_SIZE: usize = 64 * 1024;
+
+/// Call `on_data` with the payload of every `data: ` line of an SSE stream,
+/// stopping at the `[DONE]` sentinel. One line buffer is reused for the whole
+/// stream, and lines stay raw bytes: other lines are dropped on a prefix
+/// compare without UTF-8 validation, and payloads go to the JSON parser as-is.
+fn for_each_sse_data(mut reader: impl BufRead, mut on_data: impl FnMut(&[u8])) -> Result<()> {
+    let mut line = Vec::new();
+    loop {
+        line.clear();
+        if reader.read_until(b'\n', &mut line)? == 0 {
             break;
         }
-        let Ok(event) = serde_json::from_str::<serde_json::Value>(data) else {
+        let Some(data) = line.strip_prefix(b"data: ") else {
             continue;
         };
-        if event.get("type") == Some(&serde_json::json!("response.output_text.delta")) {
-            if let Some(delta) = event.get("delta").and_then(|d| d.as_str()) {
-                out.push_str(delta);
-            }
-        } else if let Some(delta) = event.get("delta") {
-            if let Some(text) = delta.get("text").and_then(|t| t.as_str()) {
-                out.push_str(text);
-            } else if let Some(text) = delta.as_str() {
-                out.push_str(text);
-            }
+        let data = data.strip_suffix(b"\n").unwrap_or(data);
+        let data = data.strip_suffix(b"\r").unwrap_or(data);
+        if data == b"[DONE]" {
+            break;
         }
+        on_data(data);
     }
-
-    Ok(out.trim().to_string())
+    Ok(())
 }
 
 /// OpenAI-compatible backend: `{base_url}/chat/completions`, non-streaming.
-fn call_openai_compatible(
-    config: &Config,
-    prompt: &str,
-    model: &str,
-    system_prompt: &str,
-) -> Result<String> {
+fn call_openai_compatible(config: &Config, prompt: &str, model: &str) -> Result<String> {
     let base_url = config.base_url().ok_or_else(|| {
         anyhow::anyhow!(
             "No base URL set. Run `jose provider set openai-compatible --base-url <url>` \
@@ -94,17 +189,15 @@ fn call_openai_compatible(
         )
     })?;
     let url = format!("{}/chat/completions", base_url.trim_end_matches('/'));
+    let system_prompt = build_system_prompt();
 
-    let payload = serde_json::json!({
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt},
-        ],
-        "stream": false,
-    });
+    let payload = ChatCompletionRequest {
+        model,
+        messages: [Message::system(&system_prompt), Message::user(prompt)],
+        stream: false,
+    };
 
-    let mut req = reqwest::blocking::Client::new()
+    let mut req = http::client()
         .post(&url)
         .header("Content-Type", "application/json")
         .json(&payload)